@@ -1,14 +1,206 @@
 # Useful functions to analyse Oh distortions in perovskites
 from typing import Optional
-from copy import deepcopy
+from collections import OrderedDict
+import hashlib
+import itertools
+import logging
 import numpy as np
+from scipy.spatial import cKDTree
 
 # Pymatgen stuff
 from pymatgen.core.structure import Structure
-from pymatgen.io.ase import AseAtomsAdaptor 
 from pymatgen.analysis.local_env import CrystalNN
+from pymatgen.optimization.neighbors import find_points_in_spheres
 
-aaa = AseAtomsAdaptor()
+logger = logging.getLogger(__name__)
+
+# Numba is optional: if available, the angle kernel is JIT compiled
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+def _periodic_pairs_within(
+    frac: np.ndarray,
+    lattice: np.ndarray,
+    cutoff: float,
+) -> np.ndarray:
+    """
+    Pairs of points closer than cutoff to each other (or to a periodic image of each other), using a KD-tree.
+
+    Args:
+        frac (np.ndarray): (N, 3) fractional coordinates.
+        lattice (np.ndarray): (3, 3) lattice matrix (lattice vectors as rows), in A.
+        cutoff (float): maximum distance between the two points of a pair, in A.
+
+    Returns:
+        np.ndarray: (P, 2) indices of the pairs, each pair only once and with i < j.
+    """
+    # Number of periodic images needed along each lattice vector to cover the cutoff
+    # (the spacing between lattice planes is 1 / norm of the reciprocal lattice vectors)
+    n_images = np.ceil(cutoff * np.linalg.norm(np.linalg.inv(lattice), axis=0)).astype(int)
+    shifts = np.array(list(itertools.product(*[range(-n, n + 1) for n in n_images])))
+    wrapped = frac % 1.0
+    images = (wrapped[None, :, :] + shifts[:, None, :]).reshape(-1, 3) @ lattice
+    owner = np.tile(np.arange(len(frac)), len(shifts))
+    # Only search from the points in the central cell
+    pairs = cKDTree(wrapped @ lattice).sparse_distance_matrix(cKDTree(images), cutoff, output_type='ndarray')
+    pairs = pairs[pairs['v'] < cutoff]
+    i, j = pairs['i'], owner[pairs['j']]
+    keep = i < j
+    return np.unique(np.stack([i[keep], j[keep]], axis=1), axis=0)
+
+def _b_x_b_angles_numpy(
+    triples: np.ndarray,
+    frac: np.ndarray,
+    lattice: np.ndarray,
+) -> np.ndarray:
+    """
+    B-X-B angles for a batch of (b_site_1, x_site, b_site_2) triples, using the minimum image convention.
+
+    Args:
+        triples (np.ndarray): (N, 3) site indices, with the X anion (the vertex of the angle) in the middle.
+        frac (np.ndarray): fractional coordinates of all sites in the structure.
+        lattice (np.ndarray): (3, 3) lattice matrix (lattice vectors as rows), in A.
+
+    Returns:
+        np.ndarray: (N,) angles, in degrees.
+    """
+    v1 = frac[triples[:, 0]] - frac[triples[:, 1]]
+    v2 = frac[triples[:, 2]] - frac[triples[:, 1]]
+    v1 -= np.rint(v1)
+    v2 -= np.rint(v2)
+    v1 = v1 @ lattice
+    v2 = v2 @ lattice
+    cos = np.einsum('ij,ij->i', v1, v2) / (np.linalg.norm(v1, axis=1) * np.linalg.norm(v2, axis=1))
+    return np.degrees(np.arccos(np.clip(cos, -1, 1)))
+
+if HAS_NUMBA:
+    # Same kernel as above, looping over the triples instead of building (N, 3) temporaries
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _b_x_b_angles_numba(triples, frac, lattice):
+        n = triples.shape[0]
+        angles = np.empty(n)
+        for t in prange(n):
+            b_1, x, b_2 = triples[t, 0], triples[t, 1], triples[t, 2]
+            dot, norm_1, norm_2 = 0.0, 0.0, 0.0
+            for k in range(3):
+                v1, v2 = 0.0, 0.0
+                for l in range(3):
+                    d1 = frac[b_1, l] - frac[x, l]
+                    d2 = frac[b_2, l] - frac[x, l]
+                    v1 += (d1 - np.rint(d1)) * lattice[l, k]
+                    v2 += (d2 - np.rint(d2)) * lattice[l, k]
+                dot += v1 * v2
+                norm_1 += v1 * v1
+                norm_2 += v2 * v2
+            cos = dot / np.sqrt(norm_1 * norm_2)
+            cos = min(1.0, max(-1.0, cos))
+            angles[t] = np.degrees(np.arccos(cos))
+        return angles
+
+    _b_x_b_angles = _b_x_b_angles_numba
+else:
+    _b_x_b_angles = _b_x_b_angles_numpy
+
+# Cache of the B-X-B angles (tuples) of the last structures seen, keyed by structure digest and parameters.
+# Only the angles are kept, not the structures themselves
+_TILTING_CACHE_SIZE = 1024
+_tilting_cache = OrderedDict()
+
+def _structure_key(struct: Structure) -> str:
+    """
+    Digest identifying a structure in the cache. Two structures get the same key if they have the same species, \
+    fractional coordinates and lattice (rounded to 6 decimals).
+    """
+    digest = hashlib.sha1()
+    digest.update(' '.join(site.species_string for site in struct).encode())
+    # + 0.0 turns -0.0 into 0.0, so both give the same bytes
+    digest.update((struct.frac_coords.round(6) + 0.0).tobytes())
+    digest.update((struct.lattice.matrix.round(6) + 0.0).tobytes())
+    return digest.hexdigest()
+
+def _get_all_tilting_angles(
+    struct: Structure,
+    b_cation: str,
+    x_anion: str,
+    distance_between_b_cations: float,
+    distance_between_b_x: float,
+    algorithm: str,
+) -> tuple:
+    """
+    Calculates all B-X-B angles (in degrees) of the structure, see get_tilting_angles for the arguments.
+    """
+    # Get all B cation and X anion sites in structure
+    species = np.array([site.species_string for site in struct])
+    b_idx = np.where(species == b_cation)[0]
+    x_idx = np.where(species == x_anion)[0]
+    if len(b_idx) == 0: # no B cation, hence no B-X-B angle (the average is nan)
+        return ()
+    frac = struct.frac_coords
+    cart = struct.cart_coords
+    lattice = struct.lattice.matrix
+    if algorithm == 'neighbors' and len(x_idx) == 0:
+        # Nothing to search for, the check below reports the missing X anions
+        x_of_b = [[] for _ in b_idx]
+    elif algorithm == 'neighbors':
+        # Find all B-X bonds (including periodic images) in a single call and bucket them per B cation
+        b_centers, x_points, _, _ = find_points_in_spheres(
+            cart[x_idx],
+            cart[b_idx],
+            r=distance_between_b_x,
+            pbc=np.array([1, 1, 1], dtype=np.int64),
+            lattice=lattice,
+            tol=1e-8,
+        )
+        order = np.argsort(b_centers, kind='stable')
+        splits = np.searchsorted(b_centers[order], np.arange(1, len(b_idx)))
+        x_of_b = [x_idx[points].tolist() for points in np.split(x_points[order], splits)]
+    elif algorithm == 'crystal_nn':
+        # Initially, was using the get_neighbors method, but think CrystalNN is more reliable, yet slower.
+        # CrystalNN is expensive, so run it once per B cation rather than once per B-B pair
+        cn = CrystalNN(search_cutoff = distance_between_b_x)
+        x_idx_set = set(x_idx.tolist())
+        x_of_b = [
+            [ site_info['site_index'] for site_info in cn.get_nn_data(struct, int(b_site)).all_nninfo if site_info['site_index'] in x_idx_set ]
+            for b_site in b_idx
+        ]
+    # Make sure we find 6 X anions neighbouring each B cation
+    counts = np.array([len(x_neighbors) for x_neighbors in x_of_b])
+    wrong = np.where(counts != 6)[0]
+    assert len(wrong) == 0, \
+        f"I find {counts[wrong].tolist()} {x_anion} surrounding the {b_cation} at sites {b_idx[wrong].tolist()}. This number should be 6!"
+    # Neighbouring B cation sites (distance between them < distance_between_b_cations).
+    # Each pair only once (i < j), to avoid double counting
+    b_pairs = _periodic_pairs_within(frac[b_idx], lattice, distance_between_b_cations)
+    # Encode the X anions surrounding each B cation as a bitmask over the X sites (bit k <-> x_idx[k]),
+    # so the X anions shared by two octahedra are a single bitwise AND
+    x_position = np.full(len(species), -1)
+    x_position[x_idx] = np.arange(len(x_idx))
+    x_masks = [sum(1 << k for k in set(x_position[x_neighbors].tolist())) for x_neighbors in x_of_b]
+    # Skip the pairs of octahedra that don't share any X anion before looping over them
+    # (a single AND of Python ints per pair, the masks can be wider than any numpy integer)
+    sharing_pairs = []
+    for i, j in b_pairs.tolist():
+        if x_masks[i] & x_masks[j]:
+            sharing_pairs.append((i, j))
+        else:
+            logger.debug('No common %s between the %s at sites %d and %d', x_anion, b_cation, b_idx[i], b_idx[j])
+    triples = []
+    for i, j in sharing_pairs:
+        b_site_1, b_site_2 = int(b_idx[i]), int(b_idx[j])
+        # Get the X anion connecting the two octahedra (the edge that the octahedra share)
+        common_x_anions = x_masks[i] & x_masks[j]
+        while common_x_anions:
+            lowest_bit = common_x_anions & -common_x_anions
+            triples.append((b_site_1, int(x_idx[lowest_bit.bit_length() - 1]), b_site_2))
+            common_x_anions ^= lowest_bit
+    # Compute all B-X-B angles at once, wrapping the bond vectors to the closest periodic image
+    # (struct.get_angle struggles with pbc, hence not used)
+    angles_b_x_b = np.round(_b_x_b_angles(np.array(triples, dtype=int).reshape(-1, 3), frac, lattice), 3)
+    return tuple(angles_b_x_b.tolist()) # in degrees
 
 def get_tilting_angles(
     struct: Structure,
@@ -39,46 +231,22 @@ def get_tilting_angles(
     Returns:
        float: Average B-X-B angle.
     """
-    # Get ase atoms object
-    atoms = aaa.get_atoms(struct)
-    # Initialize CrystalNN
-    cn = CrystalNN(search_cutoff = distance_between_b_x)
-
-    # Get all B cation sites in structure
-    b_sites = [index for index, site in enumerate(struct) if site.species_string == b_cation]
-    b_sites_copy = deepcopy(b_sites) # just for sanity
-    angles_b_x_b = []
-    # Loop for each B cation site
-    for b_site_1 in b_sites_copy:
-        b_sites_copy.remove(b_site_1) # Remove site from list to avoid double counting
-        # Get neighbouring B cation sites (distance between them < 6.4 A)
-        for b_site_2 in b_sites_copy:
-            distance = struct.get_distance(b_site_1, b_site_2)
-            if distance < distance_between_b_cations: 
-                # Get the anions surrounding each B cation
-                if algorithm == 'neighbors':
-                    # Initially, was using the get_neighbors method, but think CrystalNN is more reliable, yet slower.
-                    x_neighbors_of_b_1 = [ site.index for site in struct.get_neighbors(struct[b_site_1], r = distance_between_b_x) if site.species_string == x_anion ]
-                    x_neighbors_of_b_2 = [ site.index for site in struct.get_neighbors(struct[b_site_2], r = distance_between_b_x) if site.species_string == x_anion ]
-                elif algorithm == 'crystal_nn':
-                    x_neighbors_of_b_1 = [ site_info['site_index'] for site_info in cn.get_nn_data(struct, b_site_1).all_nninfo if site_info['site'].species_string == x_anion ] 
-                    x_neighbors_of_b_2 = [ site_info['site_index'] for site_info in cn.get_nn_data(struct, b_site_2).all_nninfo if site_info['site'].species_string == x_anion ] 
-    
-                # Make sure we find 6 X anions neighbouring the B cation
-                assert len(x_neighbors_of_b_1) == 6, f"I find {len(x_neighbors_of_b_1)} {x_anion} surrounding the {b_cation}. This number should be 6!"
-                assert len(x_neighbors_of_b_2) == 6, f"I find {len(x_neighbors_of_b_2)} {x_anion} surrounding the {b_cation}. This number should be 6!"
-
-                # Get the X anion connecting the two octahedra (the edge that the octahedra share)
-                common_x_anions = list(set(x_neighbors_of_b_1).intersection(x_neighbors_of_b_2))
-                if not common_x_anions : # no common X anion
-                    print(f'No common {x_anion} between the {b_cation}')
-                    break
-                for x_site in common_x_anions:
-                    # pymatgen_angle = round(struct.get_angle(b_site_1, x_site, b_site_2), 3) # There is a bug in this pymatgen fucntion and think it struggles with pbc?
-                    # Use ASE instead
-                    ase_angle = atoms.get_angle(b_site_1, x_site, b_site_2 , mic=True)
-                    # print("Sites ", b_site_1, x_anion, b_site_2, angle, ase_angle)
-                    angles_b_x_b.append(round(ase_angle, 3))
+    key = (_structure_key(struct), b_cation, x_anion, distance_between_b_cations, distance_between_b_x, algorithm)
+    if key in _tilting_cache:
+        _tilting_cache.move_to_end(key)
+        angles_b_x_b = _tilting_cache[key]
+    else:
+        angles_b_x_b = _get_all_tilting_angles(
+            struct,
+            b_cation,
+            x_anion,
+            distance_between_b_cations,
+            distance_between_b_x,
+            algorithm,
+        )
+        _tilting_cache[key] = angles_b_x_b
+        if len(_tilting_cache) > _TILTING_CACHE_SIZE:
+            _tilting_cache.popitem(last=False) # drop the least recently used entry
     if verbose:
-        print("Tilting angles: ", angles_b_x_b) # in degrees
+        print("Tilting angles: ", list(angles_b_x_b)) # in degrees
     return round(np.mean(angles_b_x_b), 3) # in degrees
\ No newline at end of file
@@ -1,29 +1,51 @@
 # Funtions to rotate the molecules in the A cation position, useful to avoid all molecules being parallel 
-import random
-from copy import deepcopy
+from types import SimpleNamespace
+from typing import Optional
 from pymatgen.core.structure import Structure   
+from pymatgen.optimization.neighbors import find_points_in_spheres
 import numpy as np 
 
+def _soa(struct: Structure, *fields: str) -> SimpleNamespace:
+    """
+    Site properties of the structure as numpy arrays (one entry per site), read once from the pymatgen sites.
+    Only the requested fields are built, as each of them is a pass over all sites.
+
+    Args:
+        struct (Structure): structure
+        fields (str): any of 'cart' (N, 3) cartesian coordinates, 'weights' (N,) atomic weights \
+            and 'species' (N,) species strings.
+    """
+    getters = {
+        'cart': lambda: struct.cart_coords,
+        'weights': lambda: np.array([site.species.weight for site in struct]),
+        'species': lambda: np.array([site.species_string for site in struct]),
+    }
+    return SimpleNamespace(**{field: getters[field]() for field in fields})
+
 def get_center_of_mass(
-    structure: Structure,
+    coords: np.ndarray,
+    weights: np.ndarray,
     sites_indexes: list
     ) -> np.array:
     """
     Calculates center of mass for sites specified as sites_indexes 
+
+    Args:
+        coords (np.ndarray): (N, 3) cartesian coordinates of all sites in the structure (e.g. structure.cart_coords)
+        weights (np.ndarray): (N,) atomic weights of all sites in the structure
+        sites_indexes (list): indices of the sites to average over. \
+            Can also be a (M, K) array of indices, to get the centers of mass of M molecules at once.
+    Returns:
+        np.array: (3,) center of mass, or (M, 3) if sites_indexes is 2D
     """
-    center = np.zeros(3)
-    total_weight= 0
-    for index in sites_indexes:
-        site = structure[index]
-        wt = site.species.weight
-        center += site.coords * wt
-        total_weight += wt
-    return center/ total_weight
+    sites_weights = weights[sites_indexes][..., None]
+    return (coords[sites_indexes] * sites_weights).sum(axis=-2) / sites_weights.sum(axis=-2)
 
 def get_a_cation_sites(
     struct: Structure,
     a_cation_center_species: str='C',
     radius_cutoff: float = 3.5, # in Angstroms
+    verbose: bool = False,
 ) -> list:
     """
     Get the indices of the A cation sites in the structure.
@@ -32,18 +54,35 @@ def get_a_cation_sites(
         a_cation_center_species (str, optional): Species of the A cation center. Defaults to 'C'.
         radius_cutoff (float, optional): Radius cutoff for finding the neighbours of the A cation center. \
             Defaults to 3.5 Angstroms.
+        verbose (bool, optional): Print the species found around each A cation center, \
+            useful to make sure we're getting the right atoms. Defaults to False.
     """
     # Get the central atom of all A cations, by default Carbon (e.g, A_cation = formamidinium)
-    carbon_sites = [(index, site) for index, site in enumerate(struct) if site.species_string == a_cation_center_species]
+    sites = _soa(struct, 'cart', 'species')
+    species = sites.species
+    carbon_indices = np.where(species == a_cation_center_species)[0]
+    assert len(carbon_indices) > 0, f"I find no {a_cation_center_species} in the structure to use as A cation center!"
+    # Get the indices of all atoms bonded to the central atoms, in a single neighbour search
+    centers, neighbors, _, distances = find_points_in_spheres(
+        sites.cart,
+        sites.cart[carbon_indices],
+        r=radius_cutoff,
+        pbc=np.array([1, 1, 1], dtype=np.int64),
+        lattice=struct.lattice.matrix,
+        tol=1e-8,
+    )
+    not_self = distances > 1e-8
+    centers, neighbors = centers[not_self], neighbors[not_self]
+    # Bucket the neighbours per central atom
+    order = np.argsort(centers, kind='stable')
+    splits = np.searchsorted(centers[order], np.arange(1, len(carbon_indices)))
+    neighbors_of_centers = np.split(neighbors[order], splits)
     fa_molecules = []
-    count = 0
-    for index, carbon in carbon_sites:
-        # Get the indices of all atoms bonded to the central atom
-        neighbors = struct.get_neighbors(carbon, r= radius_cutoff)
-        print([site.species_string for site in neighbors]) # Make sure we're getting the right atoms
-        fa_molecules.append([index,])
-        fa_molecules[count] += ([site.index for site in neighbors])
-        count += 1
+    for index, molecule_neighbors in zip(carbon_indices.tolist(), neighbors_of_centers):
+        molecule_neighbors = molecule_neighbors.tolist()
+        if verbose:
+            print(species[molecule_neighbors].tolist()) # Make sure we're getting the right atoms
+        fa_molecules.append([index,] + molecule_neighbors)
     # assert all elements in list have the same length
     assert len(set([len(molecule) for molecule in fa_molecules])) == 1
     return fa_molecules
@@ -53,6 +92,7 @@ def rotate_a_cation(
     fa_molecules: list,
     maximum_angle: int = 180, # in degrees
     rotation_axis: list=[0,1,0],
+    seed: Optional[int] = None,
 ):
     """ 
     Rotates A cation molecules by random angles chosen between -maximum_angle and +maximum_angle.
@@ -63,22 +103,49 @@ def rotate_a_cation(
         maximum_angle (int, optional): Random angles will be chosen between [-maximum_angle, +maximum_angle] Defaults to 180 degrees.
         rotation_axis (list, optional): Vector to rotate around. \
             For formamidinium, the vector defined between the two Nitrogens (for FA). Defaults to [0,1,0].
+        seed (int, optional): Seed for the random angles and the symmetry-breaking noise, \
+            to reproduce the same rotations. Defaults to None (different rotations on every call).
     Returns:
         Structure: structure with A cation molecules rotated 
     """
-    struct_rotated = deepcopy(struct)
-    # Need to perturb structure to break symmetries. \
+    rng = np.random.default_rng(seed)
+    # Work on a copy of the coordinates only, the structure is rebuilt at the end
+    sites = _soa(struct, 'cart', 'weights')
+    all_coords = sites.cart.copy()
+    # Add a tiny noise to break symmetries. \
     # Otherwise, it breaks some of the FA molecules when rotating (does weird shit with the H bonded to the C)
-    struct_rotated.perturb(distance = 0.000001)
-    for sites in fa_molecules:
-        angle = random.randrange(-maximum_angle, maximum_angle)
-        #print(f"Rotating by {angle} degrees")
-        center_of_mass = get_center_of_mass(struct_rotated, sites)
-        struct_rotated.rotate_sites(
-            indices = sites, 
-            theta = angle * np.pi / 180,
-            axis = rotation_axis,
-            anchor = center_of_mass, # struct_rotated[sites[0]].coords,
-            to_unit_cell = False,
-            )
-    return struct_rotated
\ No newline at end of file
+    all_coords += rng.normal(0, 0.000001, all_coords.shape)
+    all_weights = sites.weights
+    # Terms of the Rodrigues rotation formula, fixed for the rotation axis:
+    # R(theta) = cos(theta) * I + sin(theta) * K_cross + (1 - cos(theta)) * K_outer
+    axis = np.array(rotation_axis, dtype=float)
+    axis_unit = axis / np.linalg.norm(axis)
+    identity = np.eye(3)
+    k_cross = np.array([
+        [0, -axis_unit[2], axis_unit[1]],
+        [axis_unit[2], 0, -axis_unit[0]],
+        [-axis_unit[1], axis_unit[0], 0],
+        ])
+    k_outer = np.outer(axis_unit, axis_unit)
+    # All molecules have the same number of sites (see get_a_cation_sites), so rotate them all at once
+    molecules = np.array(fa_molecules) # (M, atoms_per_molecule)
+    angles = rng.integers(-maximum_angle, maximum_angle, size=len(molecules))
+    #print(f"Rotating by {angles} degrees")
+    centers_of_mass = get_center_of_mass(all_coords, all_weights, molecules) # (M, 3)
+    theta = (angles * np.pi / 180)[:, None, None]
+    rotation_matrices = np.cos(theta) * identity + np.sin(theta) * k_cross + (1 - np.cos(theta)) * k_outer # (M, 3, 3)
+    relative_coords = all_coords[molecules] - centers_of_mass[:, None, :]
+    all_coords[molecules] = np.einsum('mij,mkj->mki', rotation_matrices, relative_coords) + centers_of_mass[:, None, :]
+    # Build the rotated structure once, at the end
+    # (species_and_occu also supports partially occupied sites, unlike species)
+    struct_rotated = Structure(
+        struct.lattice,
+        struct.species_and_occu,
+        all_coords,
+        charge = struct.charge,
+        coords_are_cartesian = True,
+        site_properties = struct.site_properties,
+        labels = struct.labels,
+        properties = struct.properties,
+        )
+    return struct_rotated